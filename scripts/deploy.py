@@ -7,50 +7,143 @@
 
 
 import argparse
+import hashlib
 import json
 import os
 import sys
-from datetime import datetime
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from glob import glob
 from typing import TYPE_CHECKING
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # faster parsing/serialization when available
+
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+    json_dumps = json.dumps
 
 if TYPE_CHECKING:
     import io
     from typing import Any, Dict, Optional
 
 
-def read_file(filename):
-    with open(filename, "r") as fd:
-        content = fd.read()
+def read_json(filename):
+    with open(filename, "rb") as fd:
+        content = json_loads(fd.read())
     return content
 
 
-def read_json(filename):
-    with open(filename, "r") as fd:
-        content = json.loads(fd.read())
-    return content
+def file_checksum(filename, algorithm="md5", chunk_size=1 << 20):
+    """
+    Compute the checksum of a file without loading it entirely in memory.
+    """
+    with open(filename, "rb", buffering=0) as fd:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+
+            return hashlib.file_digest(fd, algorithm).hexdigest()
+        digest = hashlib.new(algorithm)
+        buffer = memoryview(bytearray(chunk_size))
+        while True:
+            size = fd.readinto(buffer)
+            if not size:
+                break
+            digest.update(buffer[:size])
+    return digest.hexdigest()
+
+
+def wait_futures(executor, futures):
+    """
+    Wait for all futures, cancelling pending ones as soon as any of them fails.
+
+    Errors (including sys.exit) are re-raised once running tasks are done, without
+    waiting for queued tasks that would otherwise still be started by the executor.
+    """
+    try:
+        for future in futures:
+            future.result()
+    except BaseException:
+        # equivalent to 'cancel_futures=True', which is not available before Python 3.9
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+        raise
+
+
+class FileChunks:
+    """
+    Iterable over the binary contents of a file using fixed-size chunks.
+
+    Exposing the total size allows requests to send an explicit Content-Length
+    rather than falling back to chunked transfer encoding, while the larger chunks
+    reduce the number of reads and socket writes compared to the 8 KiB default.
+    """
+
+    def __init__(self, fp, size, chunk_size=1 << 20):
+        self.fp = fp
+        self.size = size
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        return self.size
+
+    # allow the body to be rewound if the request must be retried
+    def tell(self):
+        return self.fp.tell()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.fp.seek(offset, whence)
+
+    def __iter__(self):
+        while True:
+            chunk = self.fp.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
 
 
 ZENODO_TOKEN = os.environ.get("ZENODO_TOKEN")
 if not ZENODO_TOKEN:
     sys.exit("A ZENODO_TOKEN is required to be exported in the environment!")
 
+# maximum concurrent file uploads, kept below the session connection pool size
+UPLOAD_WORKERS = 6
+# maximum concurrent file deletions when preparing a new version draft
+DELETE_WORKERS = 8
+# publication date of the release, resolved once for the whole deploy
+PUBLICATION_DATE = datetime.now(timezone.utc).date().isoformat()
+# archives larger than this are uploaded in resumable parts using a multipart upload
+UPLOAD_CHUNKED_THRESHOLD = 1 << 30
+UPLOAD_CHUNK_SIZE = 64 << 20
+# maximum concurrent parts of a single archive, kept below the connection pool size
+UPLOAD_CHUNK_WORKERS = 4
+# location of multipart upload progress files, kept away from archives matched by globs
+UPLOAD_PROGRESS_DIR = os.path.join(tempfile.gettempdir(), "zenodo-release")
+
+
+def set_env_and_output_many(pairs):
+    """helper function to echo key/value pairs to the environement files
 
-def set_env_and_output(name, value):
-    """helper function to echo a key/value pair to the environement file
+    All pairs are written at once with a single append per file.
 
     Parameters:
-    name (str)  : the name of the environment variable
-    value (str) : the value to write to file
+    pairs (dict) : the environment variable names and values to write to file
     """
+    content = "".join("%s=%s\n" % (name, value) for name, value in pairs.items())
     for env_var in ("GITHUB_ENV", "GITHUB_OUTPUT"):
         environment_file_path = os.environ.get(env_var)
-        print("Writing %s=%s to %s" % (name, value, env_var))
+        for name, value in pairs.items():
+            print("Writing %s=%s to %s" % (name, value, env_var))
 
         with open(environment_file_path, "a") as environment_file:
-            environment_file.write("%s=%s\n" % (name, value))
+            environment_file.write(content)
 
 
 class Zenodo:
@@ -63,6 +156,37 @@ class Zenodo:
         self.params = {"access_token": ZENODO_TOKEN}
         self.set_host(sandbox)
 
+        # shared session to reuse connections (keep-alive) across all API calls
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        # retry on intermittent gateway errors from Zenodo rather than failing
+        retry_options = dict(
+            total=5,
+            backoff_factor=1.0,
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False,
+        )
+        retry_methods = frozenset(["GET", "PUT", "POST", "DELETE"])
+        try:
+            retries = Retry(allowed_methods=retry_methods, **retry_options)
+        except TypeError:  # urllib3 < 1.26
+            retries = Retry(method_whitelist=retry_methods, **retry_options)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retries)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_, **__):
+        self.close()
+
+    def close(self):
+        """
+        Release the pooled connections of the shared session.
+        """
+        self.session.close()
+
     def set_host(self, sandbox=False):
         """
         Given a preference for sandbox (or not) set the API host
@@ -71,13 +195,14 @@ class Zenodo:
         if sandbox:
             self.host = "sandbox.zenodo.org"
 
-    def get(self, url):
+    def get(self, url, params=None):
         """
         Wrapper to get to handle adding host and adding params or headers
         """
         if not url.startswith("http"):
             url = "https://%s%s" % (self.host, url)
-        return requests.get(url, params=self.params, headers=self.headers)
+        params = dict(self.params, **(params or {}))
+        return self.session.get(url, params=params, headers=self.headers)
 
     def post(self, url):
         """
@@ -85,29 +210,41 @@ class Zenodo:
         """
         if not url.startswith("http"):
             url = "https://%s%s" % (self.host, url)
-        return requests.post(url, params=self.params, headers=self.headers)
+        return self.session.post(url, params=self.params, headers=self.headers)
 
-    def get_depositions(self):
+    def search_by_conceptdoi(self, doi):
         """
-        Get all current depositions.
+        Search depositions matching a concept DOI, one page at a time.
+
+        The query is filtered server-side, but pages are still followed using the
+        'next' link in case the filter is loose. Since this is a generator, no further
+        page is requested once the caller stops iterating on a match.
         """
-        response = self.get("/api/deposit/depositions")
-        if response.status_code not in [200, 201]:
-            sys.exit(
-                "Cannot query depositions: %s, %s"
-                % (response.status_code, response.json())
-            )
-        return response.json()
+        response = self.get(
+            "/api/deposit/depositions",
+            # keep the default listing order, otherwise sorted by (equal) match score
+            params={"q": 'conceptdoi:"%s"' % doi, "size": 100, "sort": "mostrecent"},
+        )
+        while True:
+            if response.status_code not in [200, 201]:
+                sys.exit(
+                    "Cannot query depositions: %s, %s"
+                    % (response.status_code, json_loads(response.content))
+                )
+            for deposit in json_loads(response.content):
+                yield deposit
+            next_url = response.links.get("next", {}).get("url")
+            if not next_url:
+                break
+            response = self.get(next_url)
 
     def find_deposit(self, doi):
         """
         Given a doi, find the deposit, return None if no match
         """
-        deposits = self.get_depositions()
-
         # Look for the matching DOI
         target_deposit = None
-        for deposit in deposits:
+        for deposit in self.search_by_conceptdoi(doi):
             if "doi" not in deposit:
                 continue
             print("looking at deposit %s" % deposit["doi"])
@@ -122,7 +259,7 @@ class Zenodo:
         """
         Create a new (empty) upload for a DOI
         """
-        response = requests.post(
+        response = self.session.post(
             "https://zenodo.org/api/deposit/depositions",
             params=self.params,
             json={},
@@ -131,9 +268,9 @@ class Zenodo:
         if response.status_code not in [200, 201]:
             sys.exit(
                 "Trouble requesting new upload: %s, %s"
-                % (response.status_code, response.json())
+                % (response.status_code, json_loads(response.content))
             )
-        return response.json()
+        return json_loads(response.content)
 
     def update_doi(self, doi):
         """
@@ -155,25 +292,42 @@ class Zenodo:
             if response.status_code not in [200, 201]:
                 sys.exit(
                     "Cannot create a new version for doi '%s'. %s"
-                    % (doi, response.json())
+                    % (doi, json_loads(response.content))
                 )
-            draft = response.json()
+            draft = json_loads(response.content)
 
-        # this is actually the next draft. cannot edit the existing doi above
-        response = self.get(draft["links"]["latest_draft"])
-        if response.status_code not in [200, 201]:
-            sys.exit("Cannot create a draft for doi '%s'. %s" % (doi, response.json()))
-        new_version = response.json()
+        # The 'newversion' action responds with the original (submitted) record, not the
+        # new draft. Only in that case, or if files are not listed, fetch the draft.
+        if not draft["submitted"] and draft.get("files") is not None:
+            new_version = draft
+        else:
+            # this is actually the next draft. cannot edit the existing doi above
+            response = self.get(draft["links"]["latest_draft"])
+            if response.status_code not in [200, 201]:
+                sys.exit(
+                    "Cannot create a draft for doi '%s'. %s"
+                    % (doi, json_loads(response.content))
+                )
+            new_version = json_loads(response.content)
 
         # this draft is based off of version N-1, so let's remove N-1's artifacts to make room
         # for version N.
-        for file in new_version.get("files", []):
-            response = requests.delete(
-                file["links"]["self"], params=self.params, headers=self.headers
+        # Deletions are issued concurrently to avoid one round trip per file.
+        files = new_version.get("files", [])
+        with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as executor:
+            responses = list(
+                executor.map(
+                    lambda file: self.session.delete(
+                        file["links"]["self"], params=self.params, headers=self.headers
+                    ),
+                    files,
+                )
             )
+        for file, response in zip(files, responses):
             if response.status_code not in [200, 204]:
                 print(
-                    "could not delete file %s: %s" % (file["filename"], response.json())
+                    "could not delete file %s: %s"
+                    % (file["filename"], json_loads(response.content))
                 )
         return new_version
 
@@ -185,11 +339,18 @@ class Zenodo:
         # Here we are uploading the new release file
         bucket_url = upload["links"]["bucket"]
 
+        # Stream the file from disk with a known length to avoid buffering it
+        size = os.path.getsize(archive)
+        headers = {
+            "Content-Length": str(size),
+            "Content-Type": "application/octet-stream",
+        }
         with open(archive, "rb") as fp:
-            response = requests.put(
+            response = self.session.put(
                 "%s/%s" % (bucket_url, os.path.basename(archive)),
-                data=fp,
+                data=FileChunks(fp, size),
                 params=self.params,
+                headers=headers,
             )
             if response.status_code not in [200, 201]:
                 sys.exit(
@@ -197,21 +358,210 @@ class Zenodo:
                     % (archive, response.status_code)
                 )
 
+        self.verify_checksum(archive, json_loads(response.content))
+
+    def upload_archive_chunked(
+        self,
+        upload,                             # type: Dict[str, Any]
+        archive,                            # type: str
+        chunk_size=UPLOAD_CHUNK_SIZE,       # type: int
+        concurrency=UPLOAD_CHUNK_WORKERS,   # type: int
+    ):                                      # type: (...) -> None
+        """
+        Given an upload response and a large archive, upload it in parallel parts.
+
+        Uses the multipart upload API of the bucket. Completed parts are recorded in a
+        progress file keyed by the archive path under 'UPLOAD_PROGRESS_DIR', such that
+        a rerun following a failure resumes the same multipart upload and skips parts
+        already transferred.
+        """
+        bucket_url = upload["links"]["bucket"]
+        url = "%s/%s" % (bucket_url, os.path.basename(archive))
+        size = os.path.getsize(archive)
+        count = (size + chunk_size - 1) // chunk_size
+
+        archive_key = hashlib.sha256(os.path.abspath(archive).encode()).hexdigest()
+        progress_path = os.path.join(UPLOAD_PROGRESS_DIR, "%s.json" % archive_key)
+        os.makedirs(UPLOAD_PROGRESS_DIR, exist_ok=True)
+        progress = {}
+        if os.path.exists(progress_path):
+            try:
+                progress = read_json(progress_path)
+            except (OSError, ValueError):
+                # unreadable (eg: truncated by an interrupted run), start over
+                progress = {}
+        if (
+            not isinstance(progress, dict)
+            or progress.get("bucket_url") != bucket_url
+            or progress.get("size") != size
+            or progress.get("chunk_size") != chunk_size
+        ):
+            progress = {}
+        resumed = bool(progress)
+
+        if not progress:
+            response = self.session.post(
+                url,
+                params=dict(self.params, uploads="", size=size, partSize=chunk_size),
+            )
+            if response.status_code in [400, 404, 405]:
+                # multipart uploads not supported by the bucket, use a single request
+                print(
+                    "Multipart upload of %s rejected (%s), uploading it at once."
+                    % (archive, response.status_code)
+                )
+                return self.upload_archive(upload, archive)
+            if response.status_code not in [200, 201]:
+                sys.exit(
+                    "Trouble initiating multipart upload of artifact %s: %s, %s"
+                    % (archive, response.status_code, response.text)
+                )
+            progress = {
+                "bucket_url": bucket_url,
+                "size": size,
+                "chunk_size": chunk_size,
+                "upload_id": json_loads(response.content)["id"],
+                "parts": {},
+            }
+        upload_id = progress["upload_id"]
+        lock = threading.Lock()
+
+        def save_progress():
+            # write then replace atomically to never leave a truncated progress file
+            with tempfile.NamedTemporaryFile(
+                "w", dir=UPLOAD_PROGRESS_DIR, suffix=".tmp", delete=False
+            ) as fd:
+                json.dump(progress, fd)
+            os.replace(fd.name, progress_path)
+
+        def restart():
+            # the stored multipart upload was aborted or expired on the server
+            print(
+                "Multipart upload %s of artifact %s is no longer valid, restarting it."
+                % (upload_id, archive)
+            )
+            # release it on the server in case it is still reserved in the bucket
+            response = self.session.delete(
+                url, params=dict(self.params, uploadId=upload_id)
+            )
+            if response.status_code not in [200, 204, 404]:
+                print(
+                    "could not abort multipart upload %s: %s, %s"
+                    % (upload_id, response.status_code, response.text)
+                )
+            os.remove(progress_path)
+            return self.upload_archive_chunked(upload, archive, chunk_size, concurrency)
+
+        def upload_part(part, strict=True):
+            with open(archive, "rb") as fp:
+                fp.seek(part * chunk_size)
+                data = fp.read(chunk_size)
+            # the local digest of the part identifies it to skip it on rerun
+            etag = hashlib.md5(data).hexdigest()
+            if progress["parts"].get(str(part)) == etag:
+                return None
+            response = self.session.put(
+                url,
+                data=data,
+                params=dict(self.params, uploadId=upload_id, partNumber=part),
+                headers={"Content-Type": "application/octet-stream"},
+            )
+            if response.status_code not in [200, 201]:
+                if not strict:
+                    return response
+                sys.exit(
+                    "Trouble uploading part %s of artifact %s with response code %s"
+                    % (part, archive, response.status_code)
+                )
+            with lock:
+                progress["parts"][str(part)] = etag
+                save_progress()
+            return response
+
+        save_progress()
+        parts = list(range(count))
+        if resumed:
+            # validate the resumed upload with the first part that must be transferred
+            while parts:
+                part = parts.pop(0)
+                response = upload_part(part, strict=False)
+                if response is None:
+                    continue
+                if response.status_code in [400, 404]:
+                    return restart()
+                if response.status_code not in [200, 201]:
+                    sys.exit(
+                        "Trouble uploading part %s of artifact %s with response code %s"
+                        % (part, archive, response.status_code)
+                    )
+                break
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(upload_part, part) for part in parts]
+            wait_futures(executor, futures)
+
+        response = self.session.post(url, params=dict(self.params, uploadId=upload_id))
+        if resumed and response.status_code in [400, 404]:
+            return restart()
+        if response.status_code not in [200, 201]:
+            sys.exit(
+                "Trouble completing multipart upload of artifact %s: %s, %s"
+                % (archive, response.status_code, response.text)
+            )
+        os.remove(progress_path)
+
+        # completion describes the multipart upload, get the resulting file from bucket
+        response = self.get(bucket_url)
+        if response.status_code != 200:
+            sys.exit(
+                "Cannot query bucket of artifact %s: %s, %s"
+                % (archive, response.status_code, response.text)
+            )
+        key = os.path.basename(archive)
+        uploaded = [
+            item
+            for item in json_loads(response.content).get("contents", [])
+            if item.get("key") == key
+        ]
+        self.verify_checksum(archive, uploaded[0] if uploaded else {})
+
+    def verify_checksum(self, archive, uploaded):
+        """
+        Given an archive and its uploaded file object, validate their checksums match.
+        """
+        # Zenodo reports the checksum as '<algorithm>:<hexdigest>'
+        checksum = uploaded.get("checksum")
+        if not checksum:
+            print(
+                "WARNING: no checksum available to verify uploaded artifact %s"
+                % archive
+            )
+        else:
+            algorithm, _, remote_digest = checksum.partition(":")
+            local_digest = file_checksum(archive, algorithm)
+            if local_digest != remote_digest:
+                sys.exit(
+                    "Checksum mismatch for artifact %s: %s (local) != %s (remote)"
+                    % (archive, local_digest, remote_digest)
+                )
+
     def publish(self, data):
         """
         Given a data response from a new metadata upload, publish it.
         """
         publish_url = data["links"]["publish"]
-        r = requests.post(publish_url, params=self.params)
+        r = self.session.post(publish_url, params=self.params)
         if r.status_code not in [200, 201, 202]:
-            sys.exit("Issue publishing record: %s, %s" % (r.status_code, r.json()))
+            sys.exit(
+                "Issue publishing record: %s, %s"
+                % (r.status_code, json_loads(r.content))
+            )
 
-        published = r.json()
+        published = json_loads(r.content)
         print("::group::Record")
         print(json.dumps(published, indent=4))
         print("::endgroup::")
-        for k, v in published["links"].items():
-            set_env_and_output(k, v)
+        set_env_and_output_many(published["links"])
 
     def upload_metadata(
         self,
@@ -228,30 +578,30 @@ class Zenodo:
 
         Note that if we don't have a zenodo.json we could use the old one.
         """
-        metadata = upload["metadata"]
+        # work on a copy to avoid altering the upload response (eg: on retry)
+        metadata = dict(upload["metadata"])
 
         # updates from zenodo.json
         if zenodo_json:
             metadata.update(read_json(zenodo_json))
         metadata["version"] = version
-        metadata["publication_date"] = str(datetime.today().strftime("%Y-%m-%d"))
+        metadata["publication_date"] = PUBLICATION_DATE
 
         # New .zenodo.json may be missing this
         if "upload_type" not in metadata:
             metadata["upload_type"] = "software"
-        self.headers.update({"Content-Type": "application/json"})
 
         # Update the related info to use the url to the current release
         if html_url:
-            metadata.setdefault("related_identifiers", [])
-            metadata["related_identifiers"].append(
+            related_identifiers = metadata.get("related_identifiers", [])
+            metadata["related_identifiers"] = related_identifiers + [
                 {
                     "identifier": html_url,
                     "relation": "isSupplementTo",
                     "resource_type": "software",
                     "scheme": "url",
                 }
-            )
+            ]
 
         if title is not None:
             metadata["title"] = title
@@ -263,17 +613,18 @@ class Zenodo:
 
         # Make the deposit!
         url = "https://zenodo.org/api/deposit/depositions/%s" % upload["id"]
-        response = requests.put(
+        response = self.session.put(
             url,
-            data=json.dumps({"metadata": metadata}),
+            data=json_dumps({"metadata": metadata}),
             params=self.params,
-            headers=self.headers,
+            headers={**self.headers, "Content-Type": "application/json"},
         )
         if response.status_code != 200:
             sys.exit(
-                "Trouble uploading metadata %s, %s" % (response.status_code, response.json())
+                "Trouble uploading metadata %s, %s"
+                % (response.status_code, json_loads(response.content))
             )
-        return response.json()
+        return json_loads(response.content)
 
 
 def upload_archive(
@@ -290,36 +641,64 @@ def upload_archive(
     """
     Upload an archive to an existing Zenodo "versions DOI"
     """
-    archive = os.path.abspath(archive)
-    if not os.path.exists(archive):
-        sys.exit("Archive %s does not exist." % archive)
-
-    cli = Zenodo(sandbox=sandbox)
-
-    if doi:
-        upload = cli.update_doi(doi=doi)
+    # An existing path is used literally, even if its name contains pattern characters.
+    # Patterns are checked on the given argument, not on the parent directories that
+    # 'abspath' would add from the working directory.
+    if os.path.exists(archive):
+        paths = [os.path.abspath(archive)]
+    elif any(char in archive for char in "*?["):
+        paths = [os.path.abspath(path) for path in glob(archive)]
+        if not paths:
+            sys.exit("Archive pattern %s does not match any file." % archive)
     else:
-        if not zenodo_json:
-            sys.exit("You MUST provided a .zenodo.json template to create a new DOI.")
-        upload = cli.new_doi()
-
-    # Use a glob matching pattern to upload new files (also ensures exist)
-    for path in glob(archive):
-        cli.upload_archive(upload, path)
-
-    # Finally, load .zenodo.json and add version
-    data = cli.upload_metadata(
-        upload,
-        zenodo_json,
-        version,
-        html_url,
-        title=title,
-        description=description,
-        description_file=description_file,
-    )
+        sys.exit("Archive %s does not exist." % os.path.abspath(archive))
+
+    with Zenodo(sandbox=sandbox) as cli:
+        if doi:
+            upload = cli.update_doi(doi=doi)
+        else:
+            if not zenodo_json:
+                sys.exit(
+                    "You MUST provided a .zenodo.json template to create a new DOI."
+                )
+            upload = cli.new_doi()
+
+        # Large archives are uploaded one at a time, each one already using concurrent
+        # parts, to keep memory and connections bounded by 'UPLOAD_CHUNK_WORKERS'.
+        large_paths = []
+        small_paths = []
+        for path in paths:
+            if os.path.getsize(path) > UPLOAD_CHUNKED_THRESHOLD:
+                large_paths.append(path)
+            else:
+                small_paths.append(path)
+        for path in large_paths:
+            cli.upload_archive_chunked(upload, path)
+
+        # Other files matched by a glob pattern are uploaded concurrently
+        if len(small_paths) == 1:
+            cli.upload_archive(upload, small_paths[0])
+        elif small_paths:
+            with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+                futures = [
+                    executor.submit(cli.upload_archive, upload, path)
+                    for path in small_paths
+                ]
+                wait_futures(executor, futures)
+
+        # Finally, load .zenodo.json and add version
+        data = cli.upload_metadata(
+            upload,
+            zenodo_json,
+            version,
+            html_url,
+            title=title,
+            description=description,
+            description_file=description_file,
+        )
 
-    # Finally, publish
-    cli.publish(data)
+        # Finally, publish
+        cli.publish(data)
 
 
 def get_parser():